@@ -1,14 +1,61 @@
-from fastapi import FastAPI, HTTPException, Query
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.staticfiles import StaticFiles
 from pathlib import Path
+import functools
+import logging
+import orjson
+import queue
+import signal
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 from typing import List, Optional
 
 app = FastAPI(title="Fair Health Benchmark Lookup")
 
+logger = logging.getLogger(__name__)
+
 DB_PATH = Path("data/allowed_amounts.sqlite")
-UI_PATH = Path("frontend/index.html")
+UI_DIR = Path("frontend")
+
+# Applied to every connection we open. journal_mode=WAL also persists in the
+# database file (set at build time), so readers never block the log writer.
+CONNECTION_PRAGMAS = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-65536;
+PRAGMA mmap_size=268435456;
+PRAGMA busy_timeout=5000;
+"""
+
+READ_POOL_SIZE = 8
+
+# Lookup log rows are committed in batches of up to this many rows...
+LOG_BATCH_SIZE = 50
+# ...or after this many seconds, whichever comes first
+LOG_FLUSH_INTERVAL = 0.1
+
+DB_MISSING_DETAIL = "Allowed amounts database not found. Data build may not have run."
+
+# allowed_amounts is read-only between builds and small enough to hold in
+# memory, so /lookup never queries it: rows are loaded once into rows_by_code.
+LOAD_SQL = """
+SELECT geozip, code, description,
+       "50th", "60th", "70th", "75th", "80th", "85th", "90th", "95th",
+       product, modifier
+FROM allowed_amounts
+"""
+
+# Fields of each in-memory row (LOAD_SQL minus geozip), in order
+ROW_COLUMNS = (
+    "code", "description",
+    "50th", "60th", "70th", "75th", "80th", "85th", "90th", "95th",
+    "product", "modifier"
+)
 
 
 # -----------------------
@@ -16,35 +63,162 @@ UI_PATH = Path("frontend/index.html")
 # -----------------------
 def get_connection():
     if not DB_PATH.exists():
-        raise HTTPException(
-            status_code=500,
-            detail="Allowed amounts database not found. Data build may not have run."
-        )
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+        raise HTTPException(status_code=500, detail=DB_MISSING_DETAIL)
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=256)
+    conn.set_trace_callback(None)
+    conn.executescript(CONNECTION_PRAGMAS)
+    # Rows stay plain tuples; columns are named by position (see ROW_COLUMNS)
     return conn
 
 
+class ConnectionPool:
+    """Fixed set of read connections, kept open so each page cache stays warm."""
+
+    def __init__(self, size):
+        self._conns = queue.Queue(maxsize=size)
+        for _ in range(size):
+            self._conns.put(get_connection())
+
+    @contextmanager
+    def acquire(self):
+        conn = self._conns.get()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def release(self, conn):
+        self._conns.put(conn)
+
+    def close(self):
+        while not self._conns.empty():
+            self._conns.get_nowait().close()
+
+
+# Reads go through the pool; all writes share one connection so SQLite only
+# ever sees a single writer.
+read_pool = None
+write_conn = None
+write_lock = threading.Lock()
+
+# Lookup log rows waiting to be written, and the thread that writes them
+log_queue = queue.Queue()
+log_writer = None
+
+# (generation, index), swapped whole on reload. index maps (geozip, code) -> list
+# of row tuples (see ROW_COLUMNS); generation goes up by one on every reload.
+rows_by_code = None
+reload_lock = threading.Lock()
+
+
+@app.on_event("startup")
+def open_connections():
+    global read_pool, write_conn, log_writer
+    # If the build hasn't run, stay up and let /lookup report it per request
+    if not DB_PATH.exists():
+        return
+    read_pool = ConnectionPool(READ_POOL_SIZE)
+    write_conn = get_connection()
+    # Created once here, before the log writer can insert into it
+    ensure_log_table(write_conn)
+    log_writer = threading.Thread(target=write_log_batches, args=(write_conn,), daemon=True)
+    log_writer.start()
+
+    reload_rows_by_code()
+    # `kill -HUP` picks up a rebuilt database without a restart. Signal handlers
+    # can only be installed from the main thread (not the case under TestClient).
+    if hasattr(signal, "SIGHUP") and threading.current_thread() is threading.main_thread():
+        signal.signal(
+            signal.SIGHUP,
+            lambda signum, frame: threading.Thread(target=reload_rows_by_code, daemon=True).start()
+        )
+
+
+@app.on_event("shutdown")
+def close_connections():
+    global read_pool, write_conn, log_writer
+    if log_writer is not None:
+        # Flush whatever is still queued before the writer connection closes
+        log_queue.put(None)
+        log_writer.join()
+        log_writer = None
+    if read_pool is not None:
+        read_pool.close()
+        read_pool = None
+    if write_conn is not None:
+        write_conn.close()
+        write_conn = None
+
+
+def get_read_pool():
+    if read_pool is None:
+        raise HTTPException(status_code=500, detail=DB_MISSING_DETAIL)
+    return read_pool
+
+
+def get_rows_by_code():
+    if rows_by_code is None:
+        raise HTTPException(status_code=500, detail=DB_MISSING_DETAIL)
+    return rows_by_code
+
+
+def load_rows_by_code(conn):
+    # Products, descriptions and prices repeat across thousands of rows; keeping
+    # one shared str per distinct value cuts the index to a fraction of the size
+    values = {}
+    index = {}
+    for r in conn.execute(LOAD_SQL):
+        row = tuple([values.setdefault(v, v) for v in r])
+        index.setdefault((row[0], row[1]), []).append(row[1:])
+    return index
+
+
+def reload_rows_by_code():
+    global rows_by_code
+    with reload_lock:
+        with get_read_pool().acquire() as conn:
+            index = load_rows_by_code(conn)
+        generation = rows_by_code[0] + 1 if rows_by_code is not None else 0
+        rows_by_code = (generation, index)
+    # Entries for older generations can never be hit again; this only frees them
+    _resolve.cache_clear()
+
+
 def ensure_log_table(conn):
     # Keep this if you still want runtime logging (even if you removed GitHub export)
-    conn.execute("""
-    CREATE TABLE IF NOT EXISTS lookup_log (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        lookup_time TEXT NOT NULL,
-        geozip INTEGER NOT NULL,
-        code TEXT NOT NULL,
-        modifier TEXT,
-        product TEXT,
-        match_type TEXT,
-        success INTEGER NOT NULL
-    )
-    """)
-    conn.commit()
-
-
-def log_lookup(conn, geozip, code, modifier, product, match_type, success):
-    conn.execute("""
-    INSERT INTO lookup_log (
+    with write_lock:
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS lookup_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            lookup_time TEXT NOT NULL,
+            geozip INTEGER NOT NULL,
+            code TEXT NOT NULL,
+            modifier TEXT,
+            product TEXT,
+            match_type TEXT,
+            success INTEGER NOT NULL
+        )
+        """)
+        conn.commit()
+
+
+LOG_INSERT_SQL = """
+INSERT INTO lookup_log (
+    lookup_time,
+    geozip,
+    code,
+    modifier,
+    product,
+    match_type,
+    success
+)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def log_lookup(lookup_time, geozip, code, modifier, product, match_type, success):
+    # Queued for the background writer; the request never waits on a commit
+    log_queue.put((
         lookup_time,
         geozip,
         code,
@@ -52,137 +226,153 @@ def log_lookup(conn, geozip, code, modifier, product, match_type, success):
         product,
         match_type,
         success
-    )
-    VALUES (?, ?, ?, ?, ?, ?, ?)
-    """, (
-        datetime.utcnow().isoformat(),
-        geozip,
-        code,
-        modifier,
-        product,
-        match_type,
-        success
     ))
-    conn.commit()
 
 
-# -----------------------
-# UI
-# -----------------------
-@app.get("/", response_class=HTMLResponse)
-def serve_ui():
-    if not UI_PATH.exists():
-        raise HTTPException(status_code=500, detail="UI file not found")
-    return UI_PATH.read_text()
+def write_log_batches(conn):
+    # Runs on the log writer thread until close_connections() queues None
+    stopping = False
+    while not stopping:
+        entry = log_queue.get()
+        if entry is None:
+            break
+        batch = [entry]
+
+        # Gather up to LOG_BATCH_SIZE rows, waiting at most LOG_FLUSH_INTERVAL
+        deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+        while len(batch) < LOG_BATCH_SIZE:
+            try:
+                entry = log_queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if entry is None:
+                stopping = True
+                break
+            batch.append(entry)
+
+        try:
+            with write_lock:
+                conn.executemany(LOG_INSERT_SQL, batch)
+                conn.commit()
+        except sqlite3.Error:
+            # Logged with the traceback; the writer keeps going with the next batch
+            logger.exception("Dropped %d lookup log row(s)", len(batch))
 
 
 # -----------------------
 # Lookup API (supports multi-code + product filter)
 # -----------------------
-@app.get("/lookup")
-def lookup(
+class ORJSONResponse(JSONResponse):
+    # Encodes with orjson (Rust) instead of the stdlib json module
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
+@functools.lru_cache(maxsize=8192)
+def _resolve(generation, geozip, code, modifier, product):
+    # Result rows for one code, cached. The index generation is part of the key,
+    # so a result computed while a reload swaps the index can't be served for the
+    # new data. The index read here is never older than `generation`. Rows are
+    # returned as tuples of (column, value) pairs so cached results can't be
+    # mutated through a response.
+    _, index = get_rows_by_code()
+
+    # Split this code's rows into modifier-specific and base rows, by product
+    modifier_by_product = {}
+    base_by_product = {}
+    for r in index.get((geozip, code), ()):
+        row = dict(zip(ROW_COLUMNS, r))
+        if product and row["product"] != product:
+            continue
+        if modifier and row["modifier"] == modifier:
+            modifier_by_product[row["product"]] = row
+        elif not row["modifier"]:
+            base_by_product[row["product"]] = row
+
+    # Determine all products present across both sets
+    products_seen = set(base_by_product.keys()) | set(modifier_by_product.keys())
+
+    # If nothing exists at all for this code
+    if not products_seen:
+        return (tuple({
+            "code": code,
+            "product": product or "",
+            "description": "",
+            "match_type": "No match found",
+            "50th": "", "60th": "", "70th": "", "75th": "",
+            "80th": "", "85th": "", "90th": "", "95th": ""
+        }.items()),)
+
+    # For each product, choose modifier row if available; else base row
+    results = []
+    for p in sorted(products_seen, key=lambda x: ("" if x is None else str(x))):
+        if modifier and p in modifier_by_product:
+            row = modifier_by_product[p]
+            row["match_type"] = "Modifier-specific rate"
+        elif p in base_by_product:
+            row = base_by_product[p]
+            row["match_type"] = "Base rate (no modifier)" if not modifier else "Base rate (modifier not on file)"
+        else:
+            # Product exists in modifier rows but not in base rows (rare edge case)
+            row = modifier_by_product[p]
+            row["match_type"] = "Modifier-specific rate"
+        results.append(tuple(row.items()))
+    return tuple(results)
+
+
+# async: the lookup never blocks (in-memory index, log rows are only queued), so
+# it runs straight on the event loop instead of taking a threadpool slot
+@app.get("/lookup", response_class=ORJSONResponse)
+async def lookup(
     geozip: int = Query(..., description="Geographic ZIP"),
     code: List[str] = Query(..., description="One or more procedure codes (repeat code=...)"),
     modifier: Optional[str] = Query(default=None, description="Modifier (optional)"),
     product: Optional[str] = Query(default=None, description="Product filter (optional)")
 ):
-    conn = get_connection()
-    ensure_log_table(conn)
+    generation, _ = get_rows_by_code()  # 500 if the database never loaded
 
     modifier_clean = modifier.strip() if modifier else None
     product_clean = product.strip() if product else None
 
     results_out = []
-    any_success = False
-
-    try:
-        for c in code:
-            code_clean = c.strip()
-
-            # --- helper: product WHERE clause ---
-            product_clause = ""
-            params_base = [geozip, code_clean]
-            if product_clean:
-                product_clause = " AND product = ?"
-                params_base.append(product_clean)
-
-            # 1) If modifier provided, fetch all modifier-specific rows (could be multiple products)
-            modifier_rows = []
-            if modifier_clean:
-                modifier_rows = conn.execute(
-                    f"""
-                    SELECT *
-                    FROM allowed_amounts
-                    WHERE geozip = ?
-                      AND code = ?
-                      AND modifier = ?
-                      {product_clause}
-                    """,
-                    params_base + [modifier_clean]  # modifier last
-                ).fetchall()
-
-            # Map modifier rows by product for easy comparison
-            modifier_by_product = {}
-            for r in modifier_rows:
-                modifier_by_product[(r["product"] if "product" in r.keys() else None)] = dict(r)
-
-            # 2) Fetch all base rows (no modifier) — again could be multiple products
-            base_rows = conn.execute(
-                f"""
-                SELECT *
-                FROM allowed_amounts
-                WHERE geozip = ?
-                  AND code = ?
-                  AND (modifier IS NULL OR modifier = '')
-                  {product_clause}
-                """,
-                params_base
-            ).fetchall()
-
-            base_by_product = {}
-            for r in base_rows:
-                base_by_product[(r["product"] if "product" in r.keys() else None)] = dict(r)
-
-            # Determine all products present across both sets
-            products_seen = set(base_by_product.keys()) | set(modifier_by_product.keys())
-
-            # If nothing exists at all for this code
-            if not products_seen:
-                results_out.append({
-                    "code": code_clean,
-                    "product": product_clean or "",
-                    "description": "",
-                    "match_type": "No match found",
-                    "50th": "", "60th": "", "70th": "", "75th": "",
-                    "80th": "", "85th": "", "90th": "", "95th": ""
-                })
-                log_lookup(conn, geozip, code_clean, modifier_clean, product_clean, "No match found", 0)
-                continue
-
-            # For each product, choose modifier row if available; else base row
-            for p in sorted(products_seen, key=lambda x: ("" if x is None else str(x))):
-                if modifier_clean and p in modifier_by_product:
-                    row = modifier_by_product[p]
-                    row["match_type"] = "Modifier-specific rate"
-                    results_out.append(row)
-                    any_success = True
-                    log_lookup(conn, geozip, code_clean, modifier_clean, row.get("product"), row["match_type"], 1)
-                elif p in base_by_product:
-                    row = base_by_product[p]
-                    row["match_type"] = "Base rate (no modifier)" if not modifier_clean else "Base rate (modifier not on file)"
-                    results_out.append(row)
-                    any_success = True
-                    log_lookup(conn, geozip, code_clean, modifier_clean, row.get("product"), row["match_type"], 1)
-                else:
-                    # Product exists in modifier rows but not in base rows (rare edge case)
-                    row = modifier_by_product[p]
-                    row["match_type"] = "Modifier-specific rate"
-                    results_out.append(row)
-                    any_success = True
-                    log_lookup(conn, geozip, code_clean, modifier_clean, row.get("product"), row["match_type"], 1)
-
-        # Always return 200 so multi-code lookups can show partial matches
-        return results_out
-
-    finally:
-        conn.close()
+
+    # Every log row from one request shares a single timestamp
+    lookup_time = datetime.utcnow().isoformat()
+
+    for c in code:
+        code_clean = c.strip()
+
+        for result in _resolve(generation, geozip, code_clean, modifier_clean, product_clean):
+            row = dict(result)
+            results_out.append(row)
+            if row["match_type"] == "No match found":
+                log_lookup(lookup_time, geozip, code_clean, modifier_clean, product_clean, row["match_type"], 0)
+            else:
+                log_lookup(lookup_time, geozip, code_clean, modifier_clean, row.get("product"), row["match_type"], 1)
+
+    # Always return 200 so multi-code lookups can show partial matches.
+    # Returned as a response directly, which also skips FastAPI's jsonable_encoder pass.
+    return ORJSONResponse(results_out)
+
+
+# -----------------------
+# UI
+# -----------------------
+class UIFiles(StaticFiles):
+    # StaticFiles already handles ETag / If-Modified-Since; let browsers skip revalidating for an hour
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = "public, max-age=3600"
+        return response
+
+
+# Not mounted: a catch-all mount at `/` would match every path and stop
+# redirect_slashes from sending /lookup/ on to /lookup
+ui_files = UIFiles(directory=UI_DIR, check_dir=False)
+
+
+@app.get("/", response_class=HTMLResponse)
+async def serve_ui(request: Request):
+    if not (UI_DIR / "index.html").exists():
+        raise HTTPException(status_code=500, detail="UI file not found")
+    return await ui_files.get_response("index.html", request.scope)
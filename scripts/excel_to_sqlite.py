@@ -1,5 +1,8 @@
+import os
 import pandas as pd
+import pyarrow as pa
 import sqlite3
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
 SOURCE_DIR = Path("data/source")
@@ -9,6 +12,45 @@ REQUIRED_COLS = {"geozip", "code", "product"}
 
 DESC_ALIASES = ["description", "full_description", "procedure_description"]
 
+INSERT_CHUNK_SIZE = 10_000
+
+# Rows are stored directly in the (geozip, code, modifier, product) B-tree, which
+# is exactly what /lookup searches, so no secondary lookup index is needed.
+# WITHOUT ROWID primary keys can't hold NULLs: "no modifier" is stored as ''.
+CREATE_TABLE_SQL = """
+CREATE TABLE allowed_amounts (
+    product TEXT NOT NULL,
+    rel_date TEXT,
+    geozip INTEGER NOT NULL,
+    code TEXT NOT NULL,
+    description TEXT,
+    modifier TEXT NOT NULL DEFAULT '',
+    record_type INTEGER,
+    "50th" TEXT,
+    "60th" TEXT,
+    "70th" TEXT,
+    "75th" TEXT,
+    "80th" TEXT,
+    "85th" TEXT,
+    "90th" TEXT,
+    "95th" TEXT,
+    source_file TEXT,
+    PRIMARY KEY (geozip, code, modifier, product)
+) WITHOUT ROWID;
+"""
+
+# No journal and no fsyncs during the load, for speed; WAL is switched on once
+# the load is done. The trade-off: a failed insert can't be rolled back, so a
+# failed or interrupted build leaves allowed_amounts partly loaded (rerun the
+# build), and a crash or power loss mid-load can corrupt the whole file,
+# including the lookup_log history kept alongside it.
+BULK_LOAD_PRAGMAS = """
+PRAGMA journal_mode=OFF;
+PRAGMA synchronous=OFF;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-200000;
+"""
+
 
 def normalize_columns(df: pd.DataFrame) -> pd.DataFrame:
     df.columns = (
@@ -34,8 +76,19 @@ def normalize_description(df: pd.DataFrame) -> pd.DataFrame:
 
 
 def normalize_code(df: pd.DataFrame) -> pd.DataFrame:
+    code = df["code"]
+
+    # Whole-number float codes are only floats because Excel stored them as numbers
+    if pd.api.types.is_float_dtype(code) and code.notna().all() and (code.round() == code).all():
+        code = code.astype("int64")
+
+    # Numeric codes convert straight to strings: nothing to strip, no ".0" to remove
+    if pd.api.types.is_integer_dtype(code):
+        df["code"] = code.astype(str)
+        return df
+
     df["code"] = (
-        df["code"]
+        code
         .astype(str)
         .str.strip()
         .str.replace(r"\.0$", "", regex=True)
@@ -52,15 +105,17 @@ def normalize_geozip(df: pd.DataFrame) -> pd.DataFrame:
 
 
 def normalize_modifier(df: pd.DataFrame) -> pd.DataFrame:
+    # Blank modifier is '' rather than NULL because modifier is part of the primary key
     if "modifier" not in df.columns:
-        df["modifier"] = None
+        df["modifier"] = ""
         return df
 
     df["modifier"] = (
         df["modifier"]
-        .astype(str)
+        .astype("string")  # keeps missing cells missing (numeric columns included) so fillna sees them
+        .fillna("")
         .str.strip()
-        .replace({"": None, "nan": None, "NaN": None, "None": None})
+        .replace({"nan": "", "NaN": "", "None": ""})
     )
     return df
 
@@ -80,53 +135,83 @@ def validate_required(df: pd.DataFrame, filename: str):
         raise ValueError(f"{filename}: Missing required column(s): {sorted(missing)}")
 
 
+def process_file(file_path: Path) -> pa.Table:
+    # Runs in a worker process: parse + normalize one workbook into an Arrow table,
+    # which pickles back to the parent as flat buffers rather than per-row objects
+    # calamine (Rust) parses xlsx several times faster than openpyxl, and the
+    # pyarrow backend keeps the string normalization below vectorized
+    df = pd.read_excel(file_path, engine="calamine", dtype_backend="pyarrow")
+
+    df = normalize_columns(df)
+    validate_required(df, file_path.name)
+
+    df = normalize_description(df)
+    df = normalize_code(df)
+    df = normalize_geozip(df)
+    df = normalize_modifier(df)
+    df = normalize_product(df)
+
+    # Traceability: which file did this row come from?
+    df["source_file"] = file_path.name
+
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def insert_rows(conn: sqlite3.Connection, table: pa.Table, filename: str):
+    column_list = ", ".join(f'"{c}"' for c in table.column_names)
+    placeholders = ", ".join("?" for _ in table.column_names)
+    sql = f"INSERT INTO allowed_amounts ({column_list}) VALUES ({placeholders})"
+
+    conn.execute("BEGIN")
+    try:
+        for batch in table.to_batches(max_chunksize=INSERT_CHUNK_SIZE):
+            # Convert column-at-a-time in Arrow's C++ (nulls come out as None), then
+            # zip into row tuples, instead of building an object DataFrame per file
+            conn.executemany(sql, zip(*(column.to_pylist() for column in batch.columns)))
+    except sqlite3.IntegrityError as e:
+        # No rollback: with journal_mode=OFF it's undefined, and the build stops here anyway
+        if e.sqlite_errorname in ("SQLITE_CONSTRAINT_PRIMARYKEY", "SQLITE_CONSTRAINT_UNIQUE"):
+            raise ValueError(f"{filename}: Duplicate (geozip, code, modifier, product) row: {e}") from e
+        raise ValueError(f"{filename}: {e}") from e
+    conn.commit()
+
+
 def build_database():
     excel_files = sorted(SOURCE_DIR.glob("*.xlsx"))
     if not excel_files:
         raise ValueError(f"No .xlsx files found in {SOURCE_DIR}")
 
     conn = sqlite3.connect(DB_PATH)
+    conn.executescript(BULK_LOAD_PRAGMAS)
 
     # Replace the table once at start of build (fresh rebuild every run)
     conn.execute("DROP TABLE IF EXISTS allowed_amounts;")
+    conn.execute(CREATE_TABLE_SQL)
     conn.commit()
 
     total_rows = 0
 
-    for file_path in excel_files:
-        df = pd.read_excel(file_path)
-
-        df = normalize_columns(df)
-        validate_required(df, file_path.name)
-
-        df = normalize_description(df)
-        df = normalize_code(df)
-        df = normalize_geozip(df)
-        df = normalize_modifier(df)
-        df = normalize_product(df)
-
-        # Traceability: which file did this row come from?
-        df["source_file"] = file_path.name
+    # Files are independent, so parse them in parallel; this process stays the
+    # only SQLite writer and inserts each file as soon as its worker finishes
+    max_workers = min(len(excel_files), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(process_file, file_path): file_path for file_path in excel_files}
+        for future in as_completed(futures):
+            file_path = futures[future]
+            table = future.result()
 
-        # Write/append
-        df.to_sql("allowed_amounts", conn, if_exists="append", index=False)
-        total_rows += len(df)
+            # Write/append
+            insert_rows(conn, table, file_path.name)
+            total_rows += table.num_rows
 
-        print(f"Loaded {len(df)} rows from {file_path.name}")
-
-    # Index for fast lookups
-    conn.execute("""
-    CREATE INDEX IF NOT EXISTS idx_allowed_lookup
-    ON allowed_amounts (geozip, code, modifier);
-    """)
-
-    # Optional index to filter by product later
-    conn.execute("""
-    CREATE INDEX IF NOT EXISTS idx_allowed_product
-    ON allowed_amounts (product);
-    """)
+            print(f"Loaded {table.num_rows} rows from {file_path.name}")
 
+    # Give the query planner selectivity stats for the primary key
+    conn.execute("ANALYZE;")
     conn.commit()
+
+    # WAL is persistent: set it once here so the app's readers and log writer run concurrently
+    conn.execute("PRAGMA journal_mode=WAL;")
     conn.close()
 
     print(f"SQLite database created at {DB_PATH} with {total_rows} total rows.")